@@ -8,25 +8,36 @@
 #
 # You should have received a copy of the GNU General Public License along with Ediacara. If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import copy
+import functools
+import heapq
+import itertools
 import os
 
+import numpy as np
 import pandas
 import matplotlib.pyplot as plt
+import matplotlib.ticker
 
 import Bio
+from Bio.SeqFeature import SeqFeature, FeatureLocation
 
 import dna_features_viewer
 
+try:
+    import pyarrow
+    import pyarrow.csv
+
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+from ._kernels import binarize_codes, scan_bases, STATUS_SYMBOLS
 from .Methyl import METHYLASES
-from .Methyl import annotate_methylation
+from .Methyl import annotate_methylation, find_methylation_sites
 
-COMPLEMENTS = {
-    "A": "T",
-    "C": "G",
-    "G": "C",
-    "T": "A",
-}
+COMPLEMENT_TABLE = str.maketrans("ACGTacgt", "TGCAtgca")  # for str.translate()
 
 # From https://github.com/nanoporetech/modkit/blob/master/book/src/intro_bedmethyl.md
 BEDMETHYL_HEADER = [
@@ -50,17 +61,62 @@ BEDMETHYL_HEADER = [
     "Nnocall",
 ]
 
+# Column types, so that pandas does not need to infer them when reading the file:
+BEDMETHYL_DTYPES = {
+    "chrom": "category",
+    "start_position": "int32",
+    "end_position": "int32",
+    "modified_base_code_and_motif": "category",
+    "score": "int32",
+    # "." is used by modkit for strand-combined counts:
+    "strand": pandas.CategoricalDtype(categories=["+", "-", "."]),
+    "strand_start_position": "int32",
+    "strand_end_position": "int32",
+    "color": "category",
+    "Nvalid_cov": "int32",
+    "percent_modified": "float64",  # compared against the cutoffs
+    "Nmod": "int32",
+    "Ncanonical": "int32",
+    "Nother_mod": "int32",
+    "Ndelete": "int32",
+    "Nfail": "int32",
+    "Ndiff": "int32",
+    "Nnocall": "int32",
+}
+
 # Remove duplicate and unnecessary columns from report:
 columns_for_pdf_report = [
     BEDMETHYL_HEADER[i] for i in [1, 5, 9, 10, 11, 12, 13, 14, 15, 16, 17]
 ] + [
     "status"
 ]  # added during binarization
+# These were designed to be more informative and fit the report:
+new_columnnames_for_pdf_report = dict(
+    zip(
+        columns_for_pdf_report,
+        [
+            "LOC",
+            "Strand",
+            "COV",
+            "% mod",
+            "MOD",
+            "STD",
+            "OTH",
+            "del",
+            "fail",
+            "diff",
+            "nocall",
+            "STATUS",
+        ],
+    )
+)
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
 # For looking up modified_base_code_and_motif entries in bedmethyl:
 MODIFICATION_CODES = pandas.read_csv(os.path.join(DATA_DIR, "mod_base_codes.csv"))
 # Adapted From https://github.com/samtools/hts-specs/blob/master/SAMtags.pdf
+# Code -> {column: value} for looking up entries without scanning the table:
+MODIFICATION_CODES_INDEX = MODIFICATION_CODES.set_index("Code").to_dict("index")
 
 
 class CustomTranslator(dna_features_viewer.BiopythonTranslator):
@@ -72,14 +128,12 @@ class CustomTranslator(dna_features_viewer.BiopythonTranslator):
         n = 8  # a good number of features to display
         # Keep longest features
         if len(features) > n:
-            feature_lengths = []
-            for feature in features:
-                feature_lengths += [len(feature.location)]
-            feature_lengths.sort(reverse=True)
-            max_length = feature_lengths[n]
+            feature_lengths = (len(feature.location) for feature in features)
+            # the (n+1)th longest length, without sorting all the lengths:
+            max_length = heapq.nlargest(n + 1, feature_lengths)[n]
             for feature in features:
                 if len(feature.location) > max_length:
-                    filtered_features += [feature]
+                    filtered_features.append(feature)
         else:  # no need to do anything if not enough features
             filtered_features = features
 
@@ -104,26 +158,46 @@ class PatternTranslator(dna_features_viewer.BiopythonTranslator):
         # There should be no other options.
 
 
+# The translators hold no per-record state, so they are shared between plots:
+CUSTOM_TRANSLATOR = CustomTranslator()
+PATTERN_TRANSLATOR = PatternTranslator()
+
+
 class BedResult:
-    """Results of a bedmethyl table analysis."""
+    """Results of a bedmethyl table analysis.
+
+
+    **Parameters**
+
+    **modification**
+    > Code of the modified base (`str`), as in the bedmethyl file.
+
+    **methylase**
+    > A `Methylase` instance.
 
-    def __init__(self, modification, methylase, bed, record):
+    **bed**
+    > The binarized bedmethyl table of the pattern matches (pandas dataframe).
+
+    **record**
+    > The reference Biopython SeqRecord.
+
+    **methylation_sites**
+    > Optional output of `find_methylation_sites()` for the record and methylase.
+    Found in the record sequence if not specified.
+
+    The status of each site is looked up by its position in the `LOC` column of the
+    bed table. If a position has several entries (for example one per strand), the
+    status of the first entry is used. Sites without an entry get the status "?".
+    """
+
+    def __init__(self, modification, methylase, bed, record, methylation_sites=None):
         self.feature_cutoff = 50  # do not create a plot if there are more features
         self.modification = modification
-        self.mod_abbreviation = MODIFICATION_CODES.loc[
-            MODIFICATION_CODES["Code"] == self.modification
-        ].Abbreviation.iloc[
-            0
-        ]  # there is only one entry so we take the first
-        self.mod_name = MODIFICATION_CODES.loc[
-            MODIFICATION_CODES["Code"] == self.modification
-        ].Name.iloc[0]
-        self.mod_chebi = MODIFICATION_CODES.loc[
-            MODIFICATION_CODES["Code"] == self.modification
-        ].ChEBI.iloc[0]
-        self.unmodified_base = MODIFICATION_CODES.loc[
-            MODIFICATION_CODES["Code"] == self.modification
-        ].Unmodified_base.iloc[0]
+        modification_code = MODIFICATION_CODES_INDEX[self.modification]
+        self.mod_abbreviation = modification_code["Abbreviation"]
+        self.mod_name = modification_code["Name"]
+        self.mod_chebi = modification_code["ChEBI"]
+        self.unmodified_base = modification_code["Unmodified_base"]
 
         self.methylase = methylase
         self.methylase_str = methylase.name  # for the report
@@ -131,37 +205,62 @@ class BedResult:
         self.bed = bed
         self.record = record
 
-        # FILTER (ANNOTATED) RECORD AND ADD STATUS:
-        filtered_features = []
-        labelstart = (
-            "@epijinn(" + self.unmodified_base + ", strand="
-        )  # unfinished to account for +/- strands
-        for feature in record.features:
-            if feature.id == "@epijinn":  # as annotated by the function
-                if feature.qualifiers["label"].startswith(labelstart):
-                    # To display seq in report:
-                    feature.qualifiers["label"] = self.unmodified_base
-                    # Assign status:
-                    # no need to check for strand as the complement won't be modified
-                    location_start = int(feature.location.start)
-                    # expect exactly one bed table entry per modified nucleotide:
-                    status_symbol = self.bed.loc[
-                        self.bed["LOC"] == location_start
-                    ].STATUS.iloc[0]
-                    # used by a custom BiopythonTranslator to colour the annotation:
-                    feature.qualifiers["status"] = status_symbol
-                    filtered_features += [feature]
-        record.features = filtered_features
-
-        if len(self.record.features) > self.feature_cutoff:
+        # FILTER METHYLATION SITES:
+        if methylation_sites is None:
+            methylation_sites = find_methylation_sites(bytes(record.seq), methylase)
+        positions, strands, nucleotides = methylation_sites
+        is_unmodified_base = nucleotides == self.unmodified_base
+        positions = positions[is_unmodified_base]
+        strands = strands[is_unmodified_base]
+        if len(positions) > self.feature_cutoff:
+            # The sites are only annotated for the plot, so there is nothing to do:
             self.img_created = False
-        else:
-            self.img_created = True
-            fig, ax1 = plt.subplots(1, 1, figsize=(8, 3))
-            graphic_record = PatternTranslator().translate_record(self.record)
-            graphic_record.plot(ax=ax1, with_ruler=False, strand_in_label_threshold=4)
+            return
+
+        # ANNOTATE A COPY OF THE RECORD WITH THE SITES AND THEIR STATUS:
+        # expect one bed table entry per modified nucleotide, see the docstring for
+        # duplicates and missing entries.
+        # No need to check for strand as the complement won't be modified:
+        status_by_location = self.bed.drop_duplicates("LOC").set_index("LOC")["STATUS"]
+        statuses = status_by_location.reindex(positions).to_numpy(dtype=object)
+        statuses[pandas.isna(statuses)] = "?"  # no bed entry for the site
+        self.record = copy.copy(record)
+        self.record.features = []
+        for position, strand, status_symbol in zip(
+            positions.tolist(), strands.tolist(), statuses
+        ):
+            self.record.features.append(
+                SeqFeature(
+                    FeatureLocation(position, position + 1, strand=strand),
+                    type="misc_feature",
+                    id="@epijinn",
+                    qualifiers={
+                        # To display seq in report:
+                        "label": self.unmodified_base,
+                        "note": methylase.name,
+                        # used by a custom BiopythonTranslator to colour it:
+                        "status": status_symbol,
+                    },
+                )
+            )
+
+        self.img_created = True
+
+    @functools.cached_property
+    def plot(self):
+        """Plot of the methylation sites, created on first access.
 
-            self.plot = fig
+        Not available if the sites were not annotated (`img_created` is False).
+        """
+        if not self.img_created:
+            raise AttributeError(
+                "no plot: more than %d sites (feature_cutoff)" % self.feature_cutoff
+            )
+        fig, ax1 = plt.subplots(1, 1, figsize=(8, 3))
+        graphic_record = PATTERN_TRANSLATOR.translate_record(self.record)
+        graphic_record.plot(ax=ax1, with_ruler=False, strand_in_label_threshold=4)
+
+        return fig
 
 
 class BedmethylItem:
@@ -187,20 +286,64 @@ class BedmethylItem:
         self.id = reference.id
         self.bed = bedmethyl
         self.reference_length = len(self.record)
+        self.annotated_records = {}  # methylase name: annotated copy of the record
+
+    # The sequence buffers and bed partitions are cached on first use. They are not
+    # updated if self.record or self.bed is replaced; delete the attributes to
+    # recompute them.
+    @functools.cached_property
+    def seq_bytes(self):
+        """Sequence of the record as `bytes`, as used for the pattern search."""
+        return bytes(self.record.seq)
+
+    @functools.cached_property
+    def upper_seq_bytes(self):
+        """Uppercase sequence of the record as a NumPy array of ASCII codes."""
+        return np.frombuffer(self.seq_bytes.upper(), dtype=np.uint8)
+
+    @functools.cached_property
+    def pattern_letter_matches(self):
+        """Cache of the pattern letter matches in the sequence, shared by the
+        methylases (see `find_pattern_starts()`)."""
+        return {}
+
+    @functools.cached_property
+    def bed_subtypes(self):
+        """Dictionary of the bed table split by modification, in order of appearance."""
+        # Columnname from Bedmethyl file specification:
+        return {
+            modification: bed_subtype
+            for modification, bed_subtype in self.bed.groupby(
+                "modified_base_code_and_motif", sort=False, observed=True
+            )
+        }
 
     def perform_analysis(self, parameter_dict):
-        """Perform analysis and plot the sequence."""
-        self.fig = self.plot_record()
+        """Perform analysis. The plots are created when they are first accessed."""
         self.results = []  # BedResult instances. For easy reference in pug template.
         methylase_strings = parameter_dict["methylases"].split(" ")
         # space-separated as per specifications
+        bed_subtypes = self.bed_subtypes
+        # The strand split of the subtypes is the same for all methylases:
+        bed_subtype_strands = {
+            modification: self.split_bed_by_strand(bed_subtype)
+            for modification, bed_subtype in bed_subtypes.items()
+        }
         for methylase_str in methylase_strings:
             methylase = METHYLASES[methylase_str]
-            for modification in self.bed.modified_base_code_and_motif.unique():
+            # The pattern matches depend only on the record, not the modification:
+            (
+                methylation_sites,
+                positive_strand_locations,
+                negative_strand_locations,
+            ) = self.find_pattern_locations(methylase)
+            for modification, bed_subtype in bed_subtypes.items():
                 # RUN BED SUBSET ETC
-                bed_subtype = self.subset_bed_to_mod_subtype(self.bed, mod=modification)
-                annotated_record, bed_pattern_match = self.subset_bed_to_pattern_match(
-                    methylase, bed=bed_subtype
+                bed_pattern_match = self.subset_bed_to_locations(
+                    bed_subtype,
+                    positive_strand_locations=positive_strand_locations,
+                    negative_strand_locations=negative_strand_locations,
+                    strands=bed_subtype_strands[modification],
                 )
                 bed_binarized = self.binarize_bed(
                     bed_pattern_match,
@@ -212,39 +355,31 @@ class BedmethylItem:
                     modification=modification,
                     methylase=methylase,
                     bed=final_bed,
-                    record=annotated_record,
+                    record=self.record,
+                    methylation_sites=methylation_sites,
                 )
-                self.results += [bedresult]
+                self.results.append(bedresult)
 
     def annotate_record(self):
         return self.record
 
+    @functools.cached_property
+    def fig(self):
+        """Plot of the record, created on first access."""
+        return self.plot_record()
+
     def plot_record(self):
         fig, ax1 = plt.subplots(1, 1, figsize=(8, 2))
-        graphic_record = CustomTranslator().translate_record(self.record)
+        graphic_record = CUSTOM_TRANSLATOR.translate_record(self.record)
         graphic_record.plot(ax=ax1, with_ruler=True, strand_in_label_threshold=4)
 
         return fig
 
     @staticmethod
     def subset_bed_columns(bed):
-        bed_report = bed[columns_for_pdf_report]
-        # These were designed to be more informative and fit the report:
-        new_columnnames = [
-            "LOC",
-            "Strand",
-            "COV",
-            "% mod",
-            "MOD",
-            "STD",
-            "OTH",
-            "del",
-            "fail",
-            "diff",
-            "nocall",
-            "STATUS",
-        ]
-        bed_report.columns = new_columnnames
+        bed_report = bed.loc[:, columns_for_pdf_report].rename(
+            columns=new_columnnames_for_pdf_report
+        )
 
         return bed_report
 
@@ -255,82 +390,152 @@ class BedmethylItem:
 
         return bed_subtype
 
-    def subset_bed_to_base_matches(self, bed=None, modified_base="C"):
+    def subset_bed_to_base_matches(self, bed=None, modified_base="C", mod=None):
         if bed is None:  # optional bed allows linking multiple bed subset methods
             bed = self.bed
+        # optional mod subsets to the modification in the same pass, see
+        # subset_bed_to_mod_subtype()
         mod_base = modified_base.upper()
-        mod_base_complement = COMPLEMENTS[mod_base]
-        # POSITIVE STRAND
-        matching_positions_on_positive_strand = [
-            pos
-            for pos, base in enumerate(str(self.record.seq.upper()))
-            if base == mod_base
-        ]
-        # Columnname from Bedmethyl file specification:
-        positive_strand_filter = bed["start_position"].isin(
-            matching_positions_on_positive_strand
-        ) & (bed["strand"] == "+")
-
-        # NEGATIVE STRAND
-        matching_positions_on_negative_strand = [
-            pos
-            for pos, base in enumerate(str(self.record.seq.upper()))
-            if base == mod_base_complement
-        ]
-        negative_strand_filter = bed["start_position"].isin(
-            matching_positions_on_negative_strand
-        ) & (bed["strand"] == "-")
-
-        bed_basematch = bed.loc[positive_strand_filter | negative_strand_filter]
+        if mod_base not in ("A", "C", "G", "T"):  # str.translate would keep it
+            raise KeyError(mod_base)
+        mod_base_complement = mod_base.translate(COMPLEMENT_TABLE)
+        # Byte view of the sequence for comparing all positions at once:
+        sequence = self.upper_seq_bytes
+        (
+            matching_positions_on_positive_strand,
+            matching_positions_on_negative_strand,
+        ) = scan_bases(sequence, ord(mod_base), ord(mod_base_complement))
+        bed_basematch = self.subset_bed_to_locations(
+            bed,
+            positive_strand_locations=matching_positions_on_positive_strand,
+            negative_strand_locations=matching_positions_on_negative_strand,
+            mod=mod,
+        )
 
         return bed_basematch
 
     def subset_bed_to_pattern_match(self, methylase, bed=None):
         if bed is None:  # optional bed allows linking multiple bed subset methods
             bed = self.bed
-        methylated_index = methylase.index_pos
-        mod_base = methylase.sequence[methylated_index].upper()
-        record_copy = copy.deepcopy(self.record)
-        annotated_record = annotate_methylation(record_copy, methylases=[methylase])
-
-        # CREATE LIST OF POSITIONS
-        positive_strand_locations = []
-        negative_strand_locations = []
-        label_pos = "@epijinn(" + mod_base + ", strand=1)"
-        label_neg = "@epijinn(" + mod_base + ", strand=-1)"
-        for feature in annotated_record.features:
-            if feature.id == "@epijinn":  # as annotated by function above
-                if feature.qualifiers["label"] == label_pos:
-                    positive_strand_locations += [feature.location.start]
-                elif feature.qualifiers["label"] == label_neg:
-                    negative_strand_locations += [feature.location.start]
+        annotated_record = self.annotate_methylase_sites(methylase)
+
+        (
+            methylation_sites,
+            positive_strand_locations,
+            negative_strand_locations,
+        ) = self.find_pattern_locations(methylase)
+        bed_pattern_match = self.subset_bed_to_locations(
+            bed,
+            positive_strand_locations=positive_strand_locations,
+            negative_strand_locations=negative_strand_locations,
+        )
 
-        # SUBSET USING POSITIONS
+        return annotated_record, bed_pattern_match
+
+    def annotate_methylase_sites(self, methylase):
+        """Return a copy of the record annotated with the sites of the methylase.
+
+        The copy is cached per methylase name, so it is shared between calls.
+        """
+        if methylase.name not in self.annotated_records:
+            # annotate_methylation() only appends features, so a shallow copy with
+            # its own feature list leaves the reference record untouched:
+            record_copy = copy.copy(self.record)
+            record_copy.features = list(self.record.features)
+            self.annotated_records[methylase.name] = annotate_methylation(
+                record_copy, methylases=[methylase]
+            )
+        return self.annotated_records[methylase.name]
+
+    def find_pattern_locations(self, methylase):
+        """Find the methylation sites of the methylase in the record. Returns them
+        with the positions of the methylated base on the positive and negative
+        strands."""
+        methylation_sites = find_methylation_sites(
+            self.seq_bytes, methylase, letter_matches=self.pattern_letter_matches
+        )
+        positions, strands, nucleotides = methylation_sites
+        mod_base = methylase.sequence[methylase.index_pos].upper()
+        is_mod_base = nucleotides == mod_base
+        positive_strand_locations = positions[is_mod_base & (strands == 1)]
+        negative_strand_locations = positions[is_mod_base & (strands == -1)]
+
+        return methylation_sites, positive_strand_locations, negative_strand_locations
+
+    @staticmethod
+    def split_bed_by_strand(bed):
+        """Return the row numbers and start positions of the positive strand entries,
+        then those of the negative strand entries of the bed table."""
         # Columnname from Bedmethyl file specification:
-        positive_strand_filter = bed["start_position"].isin(
-            positive_strand_locations
-        ) & (bed["strand"] == "+")
+        start_positions = bed["start_position"].to_numpy()
+        # compared as a Series, so that a categorical strand compares category codes:
+        positive_rows = np.flatnonzero((bed["strand"] == "+").to_numpy())
+        negative_rows = np.flatnonzero((bed["strand"] == "-").to_numpy())
+        return (
+            positive_rows,
+            start_positions[positive_rows],
+            negative_rows,
+            start_positions[negative_rows],
+        )
 
-        negative_strand_filter = bed["start_position"].isin(
-            negative_strand_locations
-        ) & (bed["strand"] == "-")
+    @staticmethod
+    def subset_bed_to_locations(
+        bed,
+        positive_strand_locations,
+        negative_strand_locations,
+        strands=None,
+        mod=None,
+    ):
+        # strands: optional output of split_bed_by_strand(bed), to reuse it
+        # mod: optional modification code to subset to, in the same pass
+        if strands is None:
+            strands = BedmethylItem.split_bed_by_strand(bed)
+        positive_rows, positive_starts, negative_rows, negative_starts = strands
 
-        bed_pattern_match = bed.loc[positive_strand_filter | negative_strand_filter]
+        # SUBSET USING POSITIONS
+        positive_strand_filter = np.zeros(len(bed), dtype=bool)
+        positive_strand_filter[positive_rows] = is_in_sorted(
+            positive_starts, np.unique(positive_strand_locations)
+        )
+        negative_strand_filter = np.zeros(len(bed), dtype=bool)
+        negative_strand_filter[negative_rows] = is_in_sorted(
+            negative_starts, np.unique(negative_strand_locations)
+        )
 
-        return annotated_record, bed_pattern_match
+        location_filter = positive_strand_filter | negative_strand_filter
+        if mod is not None:
+            # Columnname from Bedmethyl file specification:
+            location_filter &= (bed["modified_base_code_and_motif"] == mod).to_numpy()
+
+        # positional take of the (usually few) matching rows:
+        bed_pattern_match = bed.take(np.flatnonzero(location_filter))
+
+        return bed_pattern_match
 
     @staticmethod
     def binarize_bed(bed, met_cutoff, nonmet_cutoff):
-        bed["status"] = "U"  # prefill undetermined
-        for index, row in bed.iterrows():
-            if row["percent_modified"] >= float(met_cutoff) * 100:
-                bed.loc[index, "status"] = "1"  # methylated, symbol may change
-            elif row["percent_modified"] <= float(nonmet_cutoff) * 100:
-                bed.loc[index, "status"] = "0"  # unmethylated
-            # symbol "?" reserved for low coverage to be implemented later
+        percent_modified = bed["percent_modified"].to_numpy(dtype=np.float64)
+        # "1": methylated (symbol may change), "0": unmethylated, "U": undetermined
+        status_codes = binarize_codes(
+            percent_modified, float(met_cutoff) * 100, float(nonmet_cutoff) * 100
+        )
+        # symbol "?" reserved for low coverage to be implemented later
+        bed["status"] = STATUS_SYMBOLS[status_codes]
         return bed
 
 
+def is_in_sorted(values, sorted_array):
+    """Return a boolean array of whether each value is in the sorted array.
+
+    Uses a binary search, so only the values are scanned, not a hash table of both.
+    """
+    if len(sorted_array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    indices = np.searchsorted(sorted_array, values)
+    indices[indices == len(sorted_array)] = 0  # out of range, cannot match
+    return sorted_array[indices] == values
+
+
 class BedmethylItemGroup:
     """A group of BedmethylItem instances for reporting.
 
@@ -349,14 +554,131 @@ class BedmethylItemGroup:
         self.parameter_dict = parameter_dict
         self.number_of_samples = len(bedmethylitems)
 
-    def perform_all_analysis_in_bedmethylitemgroup(self):
-        for bedmethylitem in self.bedmethylitems:
-            bedmethylitem.perform_analysis(parameter_dict=self.parameter_dict)
+    def perform_all_analysis_in_bedmethylitemgroup(self, n_workers=1):
+        """Perform the analysis of each BedmethylItem.
+
+
+        **Parameters**
+
+        **n_workers**
+        > Number of processes for analysing the items in parallel (`int`). Default 1
+        analyses them in this process. `None` uses all CPUs. The items are updated
+        in place either way.
+        """
+        if n_workers == 1 or self.number_of_samples < 2:
+            for bedmethylitem in self.bedmethylitems:
+                bedmethylitem.perform_analysis(parameter_dict=self.parameter_dict)
+        else:
+            # The items are independent; analysed copies are returned by the workers,
+            # and copied back into the original items:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as ex:
+                analysed_items = ex.map(
+                    analyse_bedmethylitem,
+                    self.bedmethylitems,
+                    itertools.repeat(self.parameter_dict),
+                )
+                for bedmethylitem, analysed_item in zip(
+                    self.bedmethylitems, analysed_items
+                ):
+                    bedmethylitem.__dict__.update(analysed_item.__dict__)
         self.comparisons_performed = True
 
 
+def analyse_bedmethylitem(bedmethylitem, parameter_dict):
+    """Perform the analysis of a BedmethylItem and return it (for process pools).
+
+    The figures are not created here; they are plotted when first accessed.
+    """
+    bedmethylitem.perform_analysis(parameter_dict=parameter_dict)
+    # Not needed by the report, so not worth sending back:
+    bedmethylitem.__dict__.pop("pattern_letter_matches", None)
+    return bedmethylitem
+
+
+def format_ruler_tick(x, pos):
+    """Format a ruler tick as DNA Features Viewer does, with a picklable function."""
+    return "{:,}".format(int(x))
+
+
+def make_figure_picklable(figure):
+    """Make a DNA Features Viewer figure picklable (for process pools), in place."""
+    # DNA Features Viewer formats the ruler with a lambda, which cannot be pickled.
+    # Replace it with the same formatting by a module-level function. Other
+    # formatters, for example set by the user, are left unchanged:
+    for ax in figure.axes:
+        formatter = ax.xaxis.get_major_formatter()
+        if isinstance(formatter, matplotlib.ticker.FuncFormatter):
+            if is_ruler_lambda(formatter.func):
+                ax.xaxis.set_major_formatter(
+                    matplotlib.ticker.FuncFormatter(format_ruler_tick)
+                )
+    return figure
+
+
+def is_ruler_lambda(func):
+    """Return whether a tick formatting function is the DNA Features Viewer ruler
+    lambda."""
+    return (
+        func.__name__ == "<lambda>"
+        and func.__module__.split(".")[0] == "dna_features_viewer"
+        and func(1234.5, None) == format_ruler_tick(1234.5, None)
+    )
+
+
+def read_bedmethyl(bed_path):
+    """Read a bedmethyl file into a pandas dataframe.
+
+    Uses the multithreaded PyArrow CSV reader if PyArrow is installed, otherwise
+    the pandas C parser.
+
+
+    **Parameters**
+
+    **bed_path**
+    > Path to the tab-separated bedmethyl file, without header (`str`).
+    """
+    if PYARROW_AVAILABLE:
+        column_types = {
+            column: (
+                pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+                if str(dtype) == "category"
+                else pyarrow.from_numpy_dtype(np.dtype(dtype))
+            )
+            for column, dtype in BEDMETHYL_DTYPES.items()
+        }
+        table = pyarrow.csv.read_csv(
+            bed_path,
+            read_options=pyarrow.csv.ReadOptions(
+                column_names=BEDMETHYL_HEADER, block_size=8 << 20
+            ),
+            parse_options=pyarrow.csv.ParseOptions(delimiter="\t"),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=column_types),
+        )
+        # Dictionary columns become categoricals; astype() sets the fixed categories:
+        bed_df = table.to_pandas(self_destruct=True).astype(BEDMETHYL_DTYPES)
+        # The other categories are in order of appearance; sort them as the pandas
+        # parser does:
+        for column, dtype in BEDMETHYL_DTYPES.items():
+            if isinstance(dtype, str) and dtype == "category":
+                categories = bed_df[column].cat.categories
+                bed_df[column] = bed_df[column].cat.reorder_categories(
+                    categories.sort_values()
+                )
+    else:
+        bed_df = pandas.read_csv(
+            bed_path,
+            sep="\t",
+            header=None,
+            names=BEDMETHYL_HEADER,
+            dtype=BEDMETHYL_DTYPES,
+            engine="c",
+        )
+
+    return bed_df
+
+
 def read_sample_sheet(
-    sample_sheet, genbank_dir="", bedmethyl_dir="", parameter_sheet=""
+    sample_sheet, genbank_dir="", bedmethyl_dir="", parameter_sheet="", n_workers=1
 ):
     """Read a sample sheet into a BedmethylItemGroup.
 
@@ -376,6 +698,10 @@ def read_sample_sheet(
     **parameter_sheet**
     > CSV file path (`str`). Use 'Parameter', 'Value' header for columns. If a
     'projectname' is specified, it overwrites the sample sheet value.
+
+    **n_workers**
+    > Number of threads for reading the sample files in parallel (`int`). The CSV
+    parsers release the GIL. `None` uses the `ThreadPoolExecutor` default.
     """
     # READ PARAMETERS
     param_df = pandas.read_csv(parameter_sheet, usecols=["Parameter", "Value"])
@@ -397,24 +723,59 @@ def read_sample_sheet(
     if not "unmethylated_cutoff" in parameter_dict:
         parameter_dict["unmethylated_cutoff"] = 0.3
 
-    bedmethylitems = []
-    for index, row in sample_df.iterrows():
-        genbank_name = row[2]  # number specified by the sample sheet format
-        genbank_path = os.path.join(genbank_dir, genbank_name + ".gb")  # Genbank ext
-        record = Bio.SeqIO.read(genbank_path, "genbank")
-        record.id = genbank_name
-        record.name = genbank_name
-        record.annotations["molecule_type"] = "DNA"
-
-        bed_name = row[3]  # number specified by the sample sheet format
+    samples = []
+    # column numbers specified by the sample sheet format:
+    for sample, genbank_name, bed_name in zip(sample_df[1], sample_df[2], sample_df[3]):
         bed_path = os.path.join(bedmethyl_dir, bed_name)
-        bed_df = pandas.read_csv(bed_path, header=None, delimiter="\t")
-        bed_df.columns = BEDMETHYL_HEADER
-        bedmethylitems += [
-            BedmethylItem(sample=row[1], reference=record, bedmethyl=bed_df)
-        ]  # number specified by the sample sheet format
+        samples.append((sample, genbank_name, bed_path))
+    # Samples often share a reference, so each Genbank file is read only once:
+    genbank_names = list(dict.fromkeys(sample[1] for sample in samples))
+    genbank_paths = [
+        os.path.join(genbank_dir, genbank_name + ".gb")  # Genbank ext
+        for genbank_name in genbank_names
+    ]
+
+    if n_workers == 1:
+        records = [Bio.SeqIO.read(path, "genbank") for path in genbank_paths]
+        records_by_name = dict(zip(genbank_names, records))
+        bedmethylitems = [
+            load_bedmethylitem(
+                sample, genbank_name, records_by_name[genbank_name], bed_path
+            )
+            for sample, genbank_name, bed_path in samples
+        ]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as ex:
+            records = ex.map(Bio.SeqIO.read, genbank_paths, itertools.repeat("genbank"))
+            records_by_name = dict(zip(genbank_names, records))
+            bedmethylitems = list(
+                ex.map(
+                    lambda sample: load_bedmethylitem(
+                        sample[0], sample[1], records_by_name[sample[1]], sample[2]
+                    ),
+                    samples,
+                )
+            )
 
     bedmethylitemgroup = BedmethylItemGroup(
         bedmethylitems=bedmethylitems, parameter_dict=parameter_dict
     )
     return bedmethylitemgroup
+
+
+def load_bedmethylitem(sample, genbank_name, record, bed_path):
+    """Read a bedmethyl file into a BedmethylItem of a copy of the Genbank record.
+
+    The record is copied, with its own annotations and feature list, so that it can
+    be shared between samples. The sequence and the features are not copied.
+    """
+    record = copy.copy(record)
+    record.annotations = dict(record.annotations)
+    record.features = list(record.features)
+    record.id = genbank_name
+    record.name = genbank_name
+    record.annotations["molecule_type"] = "DNA"
+
+    bed_df = read_bedmethyl(bed_path)
+
+    return BedmethylItem(sample=sample, reference=record, bedmethyl=bed_df)
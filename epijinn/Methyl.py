@@ -8,10 +8,37 @@
 #
 # You should have received a copy of the GNU General Public License along with Ediacara. If not, see <https://www.gnu.org/licenses/>.
 
-from Bio.Seq import Seq
+import functools
+import re
+
+import numpy as np
+
 from Bio.SeqFeature import SeqFeature, FeatureLocation
 
 import dnachisel
+from dnachisel.biotools import NUCLEOTIDE_TO_REGEXPR
+
+from ._kernels import match_pattern
+
+# Byte lookup tables of the sequence letters matched by each pattern letter, using
+# the same definitions as the regular expressions of dnachisel:
+PATTERN_LETTER_TABLES = {}
+for letter, regexpr in NUCLEOTIDE_TO_REGEXPR.items():
+    PATTERN_LETTER_TABLES[letter] = np.zeros(256, dtype=bool)
+    PATTERN_LETTER_TABLES[letter][list(regexpr.strip("[]").encode("ascii"))] = True
+# Number of sequence letters matched by each pattern letter:
+PATTERN_LETTER_SIZES = {
+    letter: int(table.sum()) for letter, table in PATTERN_LETTER_TABLES.items()
+}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_methylase_pattern(sequence):
+    """Return the regular expression and the `dnachisel.SequencePattern` of a
+    sequence of extended nucleotide characters, shared by methylases with the same
+    sequence."""
+    expression = dnachisel.DnaNotationPattern.dna_sequence_to_regexpr(sequence)
+    return expression, dnachisel.SequencePattern(expression)
 
 
 class Methylase:
@@ -52,31 +79,96 @@ class Methylase:
         "N": "N",
     }
 
+    complement_translation = str.maketrans(complement_table)
+
     def __init__(self, name, sequence, index_pos, index_neg):
         self.name = name
         self.sequence = sequence
         self.rc = self.reverse_complement(sequence)
         self.index_pos = index_pos
         self.index_neg = index_neg
+        # The patterns are fixed, so they are compiled only once:
+        self.is_palindrome = self.sequence == self.rc
+        # For matching against positive strand of methylation pattern:
+        self.expression, self.pattern = compile_methylase_pattern(self.sequence)
+        # For matching against negative strand of methylation pattern:
+        self.expression_rc, self.pattern_rc = compile_methylase_pattern(self.rc)
+        self.site_passes = self.compute_site_passes()
+
+    def compute_site_passes(self):
+        """Return the patterns to search, with the offsets, strands and nucleotides of
+        the methylation sites in each match, as used by `find_methylation_sites()`."""
+        last_index = len(self.sequence) - 1
+        methylated_nucleotide = self.sequence[self.index_pos]
+        passes = [(self.sequence, 1)]
+        # Repeat for reverse complement, if not palindromic:
+        if not self.is_palindrome:
+            passes.append((self.rc, -1))
+
+        site_passes = []
+        for pattern, strand in passes:
+            if strand == 1:
+                offsets = [self.index_pos]
+            else:  # reverse complement so need to count backwards
+                offsets = [last_index - self.index_pos]
+            strands = [strand]
+            nucleotides = [methylated_nucleotide]
+            if self.index_neg:  # `None` (1-base long pattern) skips the other strand
+                if strand == 1:
+                    offsets.append(self.index_neg)
+                else:
+                    offsets.append(last_index - self.index_neg)
+                strands.append(-strand)
+                nucleotides.append(self.complement_table[self.sequence[self.index_neg]])
+            site_passes.append(
+                (
+                    pattern,
+                    np.array(offsets, dtype=np.int64),
+                    np.array(strands, dtype=np.int8),
+                    np.array(nucleotides, dtype="U1"),
+                )
+            )
+        return tuple(site_passes)
 
     @staticmethod
     def reverse(sequence):
         reverse = sequence[::-1]
         return reverse
 
+    @staticmethod
+    def check_letters(sequence):
+        """Raise a KeyError for the first letter without a complement, as the
+        complement table lookup does (str.translate would keep the letter)."""
+        # The set comparison runs in C, the letters are only scanned on failure:
+        if not set(sequence) <= Methylase.complement_table.keys():
+            for letter in sequence:
+                if letter not in Methylase.complement_table:
+                    raise KeyError(letter)
+
     @staticmethod
     def complement(sequence):
-        complement_letters = [Methylase.complement_table[letter] for letter in sequence]
-        complement = "".join(complement_letters)
+        Methylase.check_letters(sequence)
+        complement = sequence.translate(Methylase.complement_translation)
         return complement
 
     @staticmethod
     def reverse_complement(sequence):
-        r = Methylase.reverse(sequence)
-        rc = Methylase.complement(r)
+        Methylase.check_letters(sequence)
+        rc = sequence[::-1].translate(Methylase.complement_translation)
         return rc
 
 
+@functools.lru_cache(maxsize=None)
+def compile_site(site):
+    """Compile a site regular expression to find all its overlapping matches in an
+    ASCII `bytes` sequence.
+
+    The lookahead returns the matches that `dnachisel.SequencePattern(site)` finds
+    with its default "loop" search, without slicing the sequence after each match.
+    """
+    return re.compile(("(?=(%s))" % site).encode("ascii"), re.ASCII)
+
+
 class Methylator:
     """Class for finding methylation sites within a pattern (site) in a sequence.
 
@@ -95,23 +187,35 @@ class Methylator:
 
     def __init__(self, sequence, site, methylases=None):
         self.sequence = sequence
+        self.sequence_bytes = sequence.encode("ascii")  # for the site patterns
         if methylases is None:
             self.methylases = list(METHYLASES.values())
         else:
             self.methylases = methylases
         self.site = site
 
-        self.pattern = dnachisel.SequencePattern(site)
-        self.regions_seq = self.pattern.find_matches(self.sequence)
+        self.pattern = compile_site(site)
+        self.regions_seq = self.find_site_regions(self.pattern)
 
         self.site_rc = Methylase.reverse_complement(site)
-        self.pattern_rc = dnachisel.SequencePattern(self.site_rc)
-        self.regions_rc = self.pattern_rc.find_matches(self.sequence)
+        if self.site_rc == site:  # palindromic, so the matches are the same
+            self.pattern_rc = self.pattern
+            self.regions_rc = list(self.regions_seq)
+        else:
+            self.pattern_rc = compile_site(self.site_rc)
+            self.regions_rc = self.find_site_regions(self.pattern_rc)
 
         self.regions = self.regions_seq + self.regions_rc
 
         self.report = ""
 
+    def find_site_regions(self, pattern):
+        """Return the dnachisel.Location of each match of a compiled site pattern."""
+        return [
+            dnachisel.Location(match.start(), match.start() + len(match.group(1)), 1)
+            for match in pattern.finditer(self.sequence_bytes)
+        ]
+
     def find_methylation_sites_in_pattern(self):
         """Run find_one_methylation_site_in_pattern() for each enzyme in methylases."""
 
@@ -125,37 +229,29 @@ class Methylator:
 
         extended_regions = self.extend_restriction_regions(methylase)
 
-        # For matching against positive strand of methylation pattern:
-        expression = dnachisel.DnaNotationPattern.dna_sequence_to_regexpr(
-            methylase.sequence
-        )
-        pattern = dnachisel.SequencePattern(expression)
-
-        # For matching against negative strand of methylation pattern:
-        expression_rc = dnachisel.DnaNotationPattern.dna_sequence_to_regexpr(
-            methylase.rc
-        )
-        pattern_rc = dnachisel.SequencePattern(expression_rc)
-
-        self.report += methylase.name + "\n"
-        self.report += "=" * len(methylase.name) + "\n"
+        # The lines of the methylase are joined and added to the report at the end:
+        report_lines = [methylase.name + "\n" + "=" * len(methylase.name) + "\n"]
 
+        # local names for the region loop:
+        sequence = self.sequence
+        pattern, pattern_rc = methylase.pattern, methylase.pattern_rc
         for region in extended_regions:
-            region_sequence = self.sequence[region.start : region.end]
-            self.report += "Region:" + str(region) + "\n"
+            region_sequence = sequence[region.start : region.end]
+            report_lines.append("Region:" + str(region) + "\n")
 
             match_location = pattern.find_matches(region_sequence)
             if len(match_location) != 0:
-                self.report += "Match in positive strand: %s\n" % region_sequence
+                report_lines.append("Match in positive strand: %s\n" % region_sequence)
             else:
-                self.report += "Positive strand: -\n"
+                report_lines.append("Positive strand: -\n")
 
             match_location_rc = pattern_rc.find_matches(region_sequence)
             if len(match_location_rc) != 0:
-                self.report += "Match in negative strand: %s\n" % region_sequence
+                report_lines.append("Match in negative strand: %s\n" % region_sequence)
             else:
-                self.report += "Negative strand: -\n"
-            self.report += "\n"
+                report_lines.append("Negative strand: -\n")
+            report_lines.append("\n")
+        self.report += "".join(report_lines)
 
     def extend_restriction_regions(self, methylase):
         """Modify list of dnachisel.Location of restriction sites to include
@@ -163,12 +259,12 @@ class Methylator:
         """
 
         extended_regions = []
+        m = len(methylase.sequence) - (methylase.index_pos + 1)
         for region in self.regions:
             region = region.extended(
                 methylase.index_neg, left=True, right=False
             )  # extension upstream
 
-            m = len(methylase.sequence) - (methylase.index_pos + 1)
             region = region.extended(
                 m, upper_limit=len(self.sequence), left=False, right=True
             )  # extension downstream
@@ -176,6 +272,100 @@ class Methylator:
         return extended_regions
 
 
+@functools.lru_cache(maxsize=None)
+def compile_pattern_tables(pattern):
+    """Return the byte lookup table of each pattern letter, stacked, and the letter
+    indices from the most to the least specific letter."""
+    letter_tables = np.stack([PATTERN_LETTER_TABLES[letter] for letter in pattern])
+    letter_order = sorted(
+        range(len(pattern)), key=lambda index: PATTERN_LETTER_SIZES[pattern[index]]
+    )
+    return letter_tables, np.array(letter_order, dtype=np.int64)
+
+
+def find_pattern_starts(sequence, pattern, letter_matches=None):
+    """Return the start positions of all matches of a pattern in a sequence.
+
+    Overlapping matches are included, as with `dnachisel.SequencePattern`.
+
+
+    **Parameters**
+
+    **sequence**
+    > ASCII sequence (`bytes` or `numpy` array of `uint8`).
+
+    **pattern**
+    > Sequence of extended nucleotide characters (`str`).
+
+    **letter_matches**
+    > Optional `dict` caching the matches of each seed letter in the sequence.
+    Share it between calls on the same sequence to scan it once per letter. Not
+    used if Numba is installed, as the compiled search makes a single pass.
+    """
+    sequence = np.frombuffer(sequence, dtype=np.uint8)
+    n_windows = len(sequence) - len(pattern) + 1
+    if n_windows <= 0:
+        return np.empty(0, dtype=np.int64)
+    letter_tables, indices = compile_pattern_tables(pattern)
+    if match_pattern is not None:  # compiled single pass, no need for letter_matches
+        return match_pattern(sequence, letter_tables, indices)
+
+    if letter_matches is None:
+        letter_matches = {}
+    # Seed with the most specific letter, then verify the other letters only at the
+    # candidate starts, leaving gaps (N) to last:
+    indices = indices.tolist()
+    seed_index = indices[0]
+    seed_letter = pattern[seed_index]
+    if seed_letter not in letter_matches:
+        letter_matches[seed_letter] = PATTERN_LETTER_TABLES[seed_letter][sequence]
+    starts = np.flatnonzero(
+        letter_matches[seed_letter][seed_index : seed_index + n_windows]
+    )
+    for index in indices[1:]:
+        if len(starts) == 0:  # no candidates left to verify
+            break
+        starts = starts[PATTERN_LETTER_TABLES[pattern[index]][sequence[starts + index]]]
+    return starts
+
+
+def find_methylation_sites(sequence, methylase, letter_matches=None):
+    """Return the methylated nucleotides of the methylase pattern matches.
+
+    The sites are in the order that `annotate_methylation()` annotates them.
+    Returns a tuple of arrays: positions, strands (1 or -1) and nucleotides.
+
+
+    **Parameters**
+
+    **sequence**
+    > ASCII sequence (`bytes` or `numpy` array of `uint8`).
+
+    **methylase**
+    > A `Methylase` instance.
+
+    **letter_matches**
+    > Optional `dict` for sharing letter matches, see `find_pattern_starts()`.
+    """
+    if letter_matches is None:
+        letter_matches = {}  # shared by the two strands
+    positions = []
+    strands = []
+    nucleotides = []
+    for pattern, offsets, site_strands, site_nucleotides in methylase.site_passes:
+        starts = find_pattern_starts(sequence, pattern, letter_matches)
+        # Each match is a row of sites, so flattening keeps the annotation order:
+        positions.append((starts[:, np.newaxis] + offsets).ravel())
+        strands.append(np.tile(site_strands, len(starts)))
+        nucleotides.append(np.tile(site_nucleotides, len(starts)))
+
+    return (
+        np.concatenate(positions),
+        np.concatenate(strands),
+        np.concatenate(nucleotides),
+    )
+
+
 def annotate_methylation(seqrecord, methylases=None):
     """Annotate SeqRecord with methylation patterns and methylated nucleotides.
 
@@ -189,117 +379,115 @@ def annotate_methylation(seqrecord, methylases=None):
     """
     if methylases is None:
         methylases = list(METHYLASES.values())
+    sequence = bytes(seqrecord.seq)  # for find_pattern_starts()
+    letter_matches = {}  # the seed letter scans are shared by all methylases
     for methylase in methylases:
         name = methylase.name
-        regex = dnachisel.DnaNotationPattern.dna_sequence_to_regexpr(methylase.sequence)
-        pattern = dnachisel.SequencePattern(regex)
-        match_location = pattern.find_matches(str(seqrecord.seq))
-        if len(match_location) != 0:
-            for match in match_location:
-                label = "@epijinn(" + methylase.name + ")"
-                seqrecord.features.append(
+        pattern_length = len(methylase.sequence)
+        # The marked nucleotides and the labels are the same for every match:
+        methylated_nucleotide = methylase.sequence[methylase.index_pos]
+        if methylase.index_neg:  # `None` (1-base long pattern) has no negative site
+            # single base, so its reverse complement is its complement:
+            complement_nucleotide = Methylase.complement_table[
+                methylase.sequence[methylase.index_neg]
+            ]
+        pattern_label = "@epijinn(" + methylase.name + ")"
+        pattern_rc_label = "@epijinn_rc(" + methylase.name + ")"
+        methylated_label = "@epijinn(" + methylated_nucleotide + ", strand=1)"
+        methylated_rc_label = "@epijinn(" + methylated_nucleotide + ", strand=-1)"
+        if methylase.index_neg:
+            complement_label = "@epijinn(" + complement_nucleotide + ", strand=-1)"
+            complement_rc_label = "@epijinn(" + complement_nucleotide + ", strand=1)"
+        # Added to the record at once, for each strand (local append for the loops):
+        new_features = []
+        add_feature = new_features.append
+
+        match_starts = find_pattern_starts(
+            sequence, methylase.sequence, letter_matches
+        ).tolist()
+        for match_start in match_starts:
+            add_feature(
+                SeqFeature(
+                    FeatureLocation(match_start, match_start + pattern_length),
+                    type="misc_feature",
+                    id="@epijinn",
+                    qualifiers={"label": pattern_label, "note": name},
+                )
+            )
+            # Mark the methylation site for checking overlap with restriction site
+            methylated_position = match_start + methylase.index_pos
+            add_feature(
+                SeqFeature(
+                    FeatureLocation(
+                        methylated_position, methylated_position + 1, strand=1
+                    ),
+                    type="misc_feature",
+                    id="@epijinn",
+                    qualifiers={"label": methylated_label, "note": name},
+                )
+            )
+            # Negative strand (don't annotate if pattern is 1-base long):
+            if methylase.index_neg:  # `None` skips this step
+                methylated_position = match_start + methylase.index_neg
+                add_feature(
                     SeqFeature(
-                        FeatureLocation(match.start, match.end),  # dnachisel.Location
+                        FeatureLocation(
+                            methylated_position, methylated_position + 1, strand=-1
+                        ),
                         type="misc_feature",
                         id="@epijinn",
-                        qualifiers={"label": label, "note": name},
+                        qualifiers={"label": complement_label, "note": name},
+                    )
+                )
+        seqrecord.features.extend(new_features)
+
+        # Repeat for reverse complement, if not palindromic:
+        if not methylase.is_palindrome:
+            new_features = []
+            add_feature = new_features.append
+            match_starts = find_pattern_starts(
+                sequence, methylase.rc, letter_matches
+            ).tolist()
+            for match_start in match_starts:
+                match_end = match_start + pattern_length
+                add_feature(
+                    SeqFeature(
+                        FeatureLocation(match_start, match_end),
+                        type="misc_feature",
+                        id="@epijinn_rc",
+                        qualifiers={"label": pattern_rc_label, "note": name},
                     )
                 )
-                # Mark the methylation site for checking overlap with restriction site
-                methylated_position = match.start + methylase.index_pos
-                methylated_nucleotide = str(methylase.sequence[methylase.index_pos])
-                label = "@epijinn(" + methylated_nucleotide + ", strand=1)"
-                seqrecord.features.append(
+                # Mark the methylation site:
+                # reverse complement so need to count backwards, and strand=-1
+                # subtract 1 to account for range
+                methylated_position = match_end - 1 - methylase.index_pos
+                add_feature(
                     SeqFeature(
                         FeatureLocation(
-                            methylated_position, methylated_position + 1, strand=1
+                            methylated_position, methylated_position + 1, strand=-1
                         ),
                         type="misc_feature",
                         id="@epijinn",
-                        qualifiers={"label": label, "note": name},
+                        qualifiers={"label": methylated_rc_label, "note": name},
                     )
                 )
-                # Negative strand (don't annotate if pattern is 1-base long):
-                if methylase.index_neg:  # `None` skips this step
-                    methylated_position = match.start + methylase.index_neg
-                    methylated_nucleotide = str(
-                        Seq(
-                            methylase.sequence[methylase.index_neg]
-                        ).reverse_complement()
-                    )
-                    label = "@epijinn(" + methylated_nucleotide + ", strand=-1)"
-                    seqrecord.features.append(
+                # Mark methylation in antisense of the enzyme site:
+                # reverse complement so need to count backwards, and strand=1
+                # subtract 1 to account for range
+                if methylase.index_neg:  # again, don't annotate if 1-base long
+                    methylated_position = match_end - 1 - methylase.index_neg
+                    add_feature(
                         SeqFeature(
                             FeatureLocation(
-                                methylated_position, methylated_position + 1, strand=-1
+                                methylated_position, methylated_position + 1, strand=1
                             ),
                             type="misc_feature",
                             id="@epijinn",
-                            qualifiers={"label": label, "note": name},
-                        )
-                    )
-
-        # Repeat for reverse complement, if not palindromic:
-        if Seq(methylase.sequence) != Seq(methylase.sequence).reverse_complement():
-            name = methylase.name
-            methylase_rc_seq = dnachisel.reverse_complement(methylase.sequence)
-            regex = dnachisel.DnaNotationPattern.dna_sequence_to_regexpr(
-                methylase_rc_seq
-            )
-            pattern = dnachisel.SequencePattern(regex)
-            match_location = pattern.find_matches(str(seqrecord.seq))
-            if len(match_location) != 0:
-                for match in match_location:
-                    label = "@epijinn_rc(" + methylase.name + ")"
-                    seqrecord.features.append(
-                        SeqFeature(
-                            FeatureLocation(
-                                match.start, match.end
-                            ),  # dnachisel.Location
-                            type="misc_feature",
-                            id="@epijinn_rc",
-                            qualifiers={"label": label, "note": name},
+                            qualifiers={"label": complement_rc_label, "note": name},
                         )
                     )
-                    # Mark the methylation site:
-                    # reverse complement so need to count backwards, and strand=-1
-                    # subtract 1 to account for range
-                    methylated_position = match.end - 1 - methylase.index_pos
-                    methylated_nucleotide = str(methylase.sequence[methylase.index_pos])
-                    label = "@epijinn(" + methylated_nucleotide + ", strand=-1)"
-                    seqrecord.features.append(
-                        SeqFeature(
-                            FeatureLocation(
-                                methylated_position, methylated_position + 1, strand=-1
-                            ),
-                            type="misc_feature",
-                            id="@epijinn",
-                            qualifiers={"label": label, "note": name},
-                        )
-                    )
-                    # Mark methylation in antisense of the enzyme site:
-                    # reverse complement so need to count backwards, and strand=1
-                    # subtract 1 to account for range
-                    if methylase.index_neg:  # again, don't annotate if 1-base long
-                        methylated_position = match.end - 1 - methylase.index_neg
-                        methylated_nucleotide = str(
-                            Seq(
-                                methylase.sequence[methylase.index_neg]
-                            ).reverse_complement()
-                        )
-                        label = "@epijinn(" + methylated_nucleotide + ", strand=1)"
-                        seqrecord.features.append(
-                            SeqFeature(
-                                FeatureLocation(
-                                    methylated_position,
-                                    methylated_position + 1,
-                                    strand=1,
-                                ),
-                                type="misc_feature",
-                                id="@epijinn",
-                                qualifiers={"label": label, "note": name},
-                            )
-                        )
+            seqrecord.features.extend(new_features)
 
     return seqrecord
 
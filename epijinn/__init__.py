@@ -1,6 +1,11 @@
 from .version import __version__
 
-from .Bedmethyl import BedmethylItem, BedmethylItemGroup, read_sample_sheet
+from .Bedmethyl import (
+    BedmethylItem,
+    BedmethylItemGroup,
+    read_bedmethyl,
+    read_sample_sheet,
+)
 
 from .Methyl import Methylase, Methylator, METHYLASES, annotate_methylation
 
@@ -0,0 +1,99 @@
+# Copyright 2024 Edinburgh Genome Foundry, University of Edinburgh
+#
+# This file is part of EpiJinn.
+#
+# EpiJinn is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# EpiJinn is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Ediacara. If not, see <https://www.gnu.org/licenses/>.
+
+"""Numerical kernels, compiled with Numba if it is installed."""
+
+import numpy as np
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Status codes returned by binarize_codes(), indexing into STATUS_SYMBOLS:
+STATUS_SYMBOLS = np.array(["U", "1", "0"], dtype=object)
+
+
+def _binarize_loop(percent_modified, met_cutoff, nonmet_cutoff):
+    codes = np.zeros(percent_modified.size, dtype=np.uint8)  # undetermined
+    for i in range(percent_modified.size):
+        if percent_modified[i] >= met_cutoff:
+            codes[i] = 1  # methylated
+        elif percent_modified[i] <= nonmet_cutoff:
+            codes[i] = 2  # unmethylated
+    return codes
+
+
+def _binarize_numpy(percent_modified, met_cutoff, nonmet_cutoff):
+    # Same precedence as the loop: the methylated cutoff is checked first.
+    codes = np.zeros(percent_modified.size, dtype=np.uint8)
+    codes[percent_modified <= nonmet_cutoff] = 2
+    codes[percent_modified >= met_cutoff] = 1
+    return codes
+
+
+if NUMBA_AVAILABLE:
+    binarize_codes = njit(cache=True)(_binarize_loop)
+else:
+    binarize_codes = _binarize_numpy
+
+
+def _scan_bases_loop(sequence, base, complement_base):
+    positive_positions = np.empty(sequence.size, dtype=np.int64)
+    negative_positions = np.empty(sequence.size, dtype=np.int64)
+    n_positive = 0
+    n_negative = 0
+    for i in range(sequence.size):
+        if sequence[i] == base:
+            positive_positions[n_positive] = i
+            n_positive += 1
+        # not elif, as with the NumPy version a base can be its own complement:
+        if sequence[i] == complement_base:
+            negative_positions[n_negative] = i
+            n_negative += 1
+    return positive_positions[:n_positive], negative_positions[:n_negative]
+
+
+def _scan_bases_numpy(sequence, base, complement_base):
+    return np.flatnonzero(sequence == base), np.flatnonzero(sequence == complement_base)
+
+
+# Positions of a base and of its complement (uint8 codes) in a uint8 sequence array:
+if NUMBA_AVAILABLE:
+    scan_bases = njit(cache=True)(_scan_bases_loop)
+else:
+    scan_bases = _scan_bases_numpy
+
+
+def _match_pattern_loop(sequence, letter_tables, letter_order):
+    # letter_tables[i] flags the sequence bytes matched by pattern letter i, checked
+    # in letter_order so that the most specific letters reject windows early.
+    n_windows = sequence.size - letter_tables.shape[0] + 1
+    starts = np.empty(max(n_windows, 0), dtype=np.int64)
+    n_starts = 0
+    for start in range(n_windows):
+        is_match = True
+        for index in letter_order:
+            if not letter_tables[index, sequence[start + index]]:
+                is_match = False
+                break
+        if is_match:
+            starts[n_starts] = start
+            n_starts += 1
+    return starts[:n_starts]
+
+
+# Start positions of a pattern in a uint8 sequence array, or None without Numba:
+if NUMBA_AVAILABLE:
+    match_pattern = njit(cache=True)(_match_pattern_loop)
+else:
+    match_pattern = None
@@ -8,52 +8,191 @@
 #
 # You should have received a copy of the GNU General Public License along with Ediacara. If not, see <https://www.gnu.org/licenses/>.
 
+import base64
+import concurrent.futures
 from datetime import datetime
+import functools
+import hashlib
+import html
+import io
+import itertools
 import os
+import re
 
-from pdf_reports import (
-    add_css_class,
-    dataframe_to_html,
-    pug_to_html,
-    style_table_rows,
-    write_report,
-)
-import pdf_reports.tools as pdf_tools
+import jinja2
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas
+from pdf_reports import GLOBALS, write_report
 
 
+from .Bedmethyl import make_figure_picklable
 from .version import __version__
 
 THIS_PATH = os.path.dirname(os.path.realpath(__file__))
 ASSETS_PATH = os.path.join(THIS_PATH, "report_assets")
 BEDMETHYLITEMGROUP_REPORT_TEMPLATE = os.path.join(ASSETS_PATH, "report.pug")
 STYLESHEET = os.path.join(ASSETS_PATH, "report_style.css")
+EPIJINN_LOGO_URL = os.path.join(ASSETS_PATH, "imgs", "epijinn.png")
+
+# For minifying the Matplotlib SVGs embedded in the report:
+SVG_METADATA = re.compile(rb"<metadata>.*?</metadata>", re.DOTALL)
+SVG_SPACE_BETWEEN_TAGS = re.compile(rb">\s+<")
+SVG_PATH_DATA = re.compile(rb' d="([^"]*)"')
+SVG_LONG_DECIMALS = re.compile(rb"(\.\d{3})\d+")
+SVG_SPACES = re.compile(rb"\s+")
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(path, mtime):
+    """Return the compiled Jinja2 template of a Pug file.
+
+    The modification time is part of the cache key, so that an edited template is
+    recompiled, while an unchanged one is parsed only once.
+    """
+    basepath, filename = os.path.split(path)
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(basepath if basepath else "."),
+        extensions=["pypugjs.ext.jinja.PyPugJSExtension"],
+    )
+    return env.get_template(filename)
+
+
+def epijinn_pug_to_stream(template, **context):
+    """Return a Jinja2 `TemplateStream` of the HTML, rendered piece by piece."""
+    if "sidebar_text" not in context:
+        now = datetime.now().strftime("%Y-%m-%d")
+        sidebar_text = "Generated on %s by EpiJinn (version %s)" % (now, __version__)
+        context["sidebar_text"] = sidebar_text
+    context.setdefault("epijinn_logo_url", EPIJINN_LOGO_URL)
+    # Same globals as pdf_reports.pug_to_html(), which recompiles on every call:
+    context = dict(GLOBALS, **context)
+    return compile_template(template, os.path.getmtime(template)).stream(context)
 
 
 def epijinn_pug_to_html(template, **context):
-    now = datetime.now().strftime("%Y-%m-%d")
-    defaults = {
-        "sidebar_text": "Generated on %s by EpiJinn (version %s)" % (now, __version__),
-        "epijinn_logo_url": os.path.join(ASSETS_PATH, "imgs", "epijinn.png"),
-    }
-    for k in defaults:
-        if k not in context:
-            context[k] = defaults[k]
-    return pug_to_html(template, **context)
-
-
-def tr_modifier_for_bed_table(tr):
-    tds = list(tr.find_all("td"))
-    if len(tds) == 0:
-        return
-    methylated = tds[-1]  # last column shows status
-    if methylated.text == "1":
-        add_css_class(tr, "negative")
-    # else:
-    #     add_css_class(tr, "positive")
+    return "".join(epijinn_pug_to_stream(template, **context))
+
+
+def format_float_column(values):
+    """Return the strings of float values, formatted as by pandas' to_html()."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return []
+    digits = pandas.get_option("display.precision")
+    magnitudes = np.abs(values[~np.isnan(values)])
+    if (
+        digits < 1
+        or pandas.get_option("display.chop_threshold") is not None
+        or pandas.get_option("display.float_format") is not None
+        or not np.isfinite(magnitudes).all()
+        or (magnitudes > 1e6).any()  # may be shown in scientific notation
+        or ((magnitudes < 10**-digits) & (magnitudes > 0)).any()  # scientific
+    ):
+        # Not the fixed-point case formatted below, so pandas does it:
+        text = pandas.DataFrame({"values": values}).to_string(index=False, header=False)
+        return [line.strip() for line in text.split("\n")]
+
+    strings = [
+        "NaN" if value != value else "%.*f" % (digits, value)
+        for value in values.tolist()
+    ]
+    decimals = [string for string in strings if "." in string]
+    if decimals:
+        # Trailing zeros are trimmed equally from all numbers, leaving one decimal:
+        n_zeros = min(len(string) - len(string.rstrip("0")) for string in decimals)
+        n_zeros = min(n_zeros, digits - 1)
+        if n_zeros:
+            strings = [
+                string[:-n_zeros] if "." in string else string for string in strings
+            ]
+    return strings
+
+
+def bed_to_html(bed):
+    """Return the HTML table of a binarized bedmethyl table.
+
+    Methylated rows (status "1" in the last column) have the class "negative".
+    """
+    columns = []
+    for column in bed.columns:
+        values = bed[column]
+        if values.dtype.kind == "f":
+            columns.append(format_float_column(values.to_numpy()))
+        elif values.dtype.kind in "iu":  # nothing to escape in integers
+            columns.append(values.to_numpy().astype(str).tolist())
+        else:
+            values = values.astype(str).tolist()
+            columns.append([html.escape(value, quote=False) for value in values])
+    is_methylated = bed.iloc[:, -1].astype(str).to_numpy() == "1"
+    if is_methylated.any():
+        row_openings = np.where(is_methylated, '<tr class="negative">', "<tr>").tolist()
+    else:  # often the case; no need to select the opening of each row
+        row_openings = itertools.repeat("<tr>")
+    row_format = "\n".join(["%s"] + ["<td>%s</td>"] * len(columns) + ["</tr>"])
+
+    lines = [
+        '<table border="1" class="dataframe ui compact celled table groups">',
+        "<thead>",
+        '<tr style="text-align: right;">',
+    ]
+    lines += ["<th>%s</th>" % html.escape(str(column), quote=False) for column in bed]
+    lines += ["</tr>", "</thead>", "<tbody>"]
+    lines += [row_format % row for row in zip(row_openings, *columns)]
+    lines += ["</tbody>", "</table>"]
+    return "\n".join(lines)
+
+
+def figure_cache_key(kind, record):
+    """Return a hash of the record content that a report figure is plotted from."""
+    key = hashlib.blake2b(kind.encode())
+    key.update(bytes(record.seq))
+    for feature in record.features:
+        location = feature.location
+        key.update(
+            repr(
+                (
+                    int(location.start),
+                    int(location.end),
+                    location.strand,
+                    feature.type,
+                    sorted(feature.qualifiers.items()),
+                )
+            ).encode()
+        )
+    return key.digest()
+
+
+def minify_svg(svg):
+    """Return a smaller version of a Matplotlib SVG (`bytes`).
+
+    Removes the metadata and the whitespace between tags, and truncates the path
+    coordinates to 3 decimals (a thousandth of a point). Transforms are left intact,
+    as they can contain scaling factors.
+    """
+    svg = SVG_SPACE_BETWEEN_TAGS.sub(b"><", SVG_METADATA.sub(b"", svg))
+
+    def minify_path_data(match):
+        path_data = SVG_LONG_DECIMALS.sub(rb"\1", match.group(1))
+        return b' d="%s"' % SVG_SPACES.sub(b" ", path_data).strip()
+
+    return SVG_PATH_DATA.sub(minify_path_data, svg)
+
+
+def render_figure_data(figure):
+    """Return the HTML-embeddable SVG data of a figure (for process pools).
+
+    The figure is closed in pyplot once rendered; it can still be rendered again.
+    """
+    output = io.BytesIO()
+    figure.savefig(output, format="svg", bbox_inches="tight")
+    plt.close(figure)
+    content = base64.b64encode(minify_svg(output.getvalue()))
+    return "data:image/svg+xml;base64," + content.decode("utf-8")
 
 
 def write_bedmethylitemgroup_report(
-    bedmethylitemgroup, pdf_file="report.pdf", html_file=None
+    bedmethylitemgroup, pdf_file="report.pdf", html_file=None, n_workers=1
 ):
     """Write a methylation analysis report with a PDF summary.
 
@@ -68,37 +207,63 @@ def write_bedmethylitemgroup_report(
 
     **html_file**
     > Optional HTML file name (`str`). The PDF is created from this HTML data.
-    """
 
+    **n_workers**
+    > Number of processes for rendering the figures in parallel (`int`). Default 1
+    renders them in this process. `None` uses all CPUs.
+    """
+    # Samples of the same reference often have identical plots, which are created
+    # and rendered only once. (Object, figure attribute) of each key, and
+    # (object, attribute, key) of each figure shown in the report:
+    figures = {}
+    targets = []
     for bedmethylitem in bedmethylitemgroup.bedmethylitems:
-        bedmethylitem.bedmethylitem_figure_data = pdf_tools.figure_data(
-            bedmethylitem.fig, fmt="svg"
-        )
+        key = figure_cache_key("record", bedmethylitem.record)
+        figures.setdefault(key, (bedmethylitem, "fig"))
+        targets.append((bedmethylitem, "bedmethylitem_figure_data", key))
         for bedresult in bedmethylitem.results:
 
-            bedresult.bed_pdf = dataframe_to_html(
-                bedresult.bed,
-                extra_classes=(
-                    "ui",
-                    "compact",
-                    "celled",
-                    # "striped",
-                    "table",
-                    "groups",
-                ),
-                use_default_classes=False,
-            )
-            bedresult.bed_pdf = style_table_rows(
-                bedresult.bed_pdf, tr_modifier_for_bed_table
-            )
+            bedresult.bed_pdf = bed_to_html(bedresult.bed)
             if bedresult.img_created:
-                bedresult.figure_data = pdf_tools.figure_data(bedresult.plot, fmt="svg")
+                key = figure_cache_key("pattern", bedresult.record)
+                figures.setdefault(key, (bedresult, "plot"))
+                targets.append((bedresult, "figure_data", key))
+
+    if n_workers == 1 or len(figures) < 2:
+        figure_data = [
+            render_figure_data(getattr(owner, attribute))
+            for owner, attribute in figures.values()
+        ]
+    else:
+        # SVG rendering is CPU-bound and the figures are independent:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as ex:
+            figure_data = list(
+                ex.map(
+                    render_figure_data,
+                    [
+                        make_figure_picklable(getattr(owner, attribute))
+                        for owner, attribute in figures.values()
+                    ],
+                )
+            )
+        # Rendered from copies, so the figures of this process are closed here:
+        for owner, attribute in figures.values():
+            plt.close(getattr(owner, attribute))
+    figure_data = dict(zip(figures, figure_data))
+    for obj, attribute, key in targets:
+        setattr(obj, attribute, figure_data[key])
 
-    html = epijinn_pug_to_html(
-        BEDMETHYLITEMGROUP_REPORT_TEMPLATE, bedmethylitemgroup=bedmethylitemgroup
-    )
-    if html_file:
-        with open(html_file, "w") as html_output:
-            html_output.write(html)
     if pdf_file:
+        # WeasyPrint needs the whole HTML as a string:
+        html = epijinn_pug_to_html(
+            BEDMETHYLITEMGROUP_REPORT_TEMPLATE, bedmethylitemgroup=bedmethylitemgroup
+        )
+        if html_file:
+            with open(html_file, "w") as html_output:
+                html_output.write(html)
         write_report(html, pdf_file, extra_stylesheets=(STYLESHEET,))
+    elif html_file:
+        # Written while rendered, without holding the whole document in memory:
+        epijinn_pug_to_stream(
+            BEDMETHYLITEMGROUP_REPORT_TEMPLATE, bedmethylitemgroup=bedmethylitemgroup
+        ).dump(html_file)
@@ -15,11 +15,16 @@ setup(
     packages=find_packages(exclude="docs"),
     install_requires=[
         "matplotlib",
+        "numpy",
         "pandas",
         "biopython",
         "dnachisel",
         "dna_features_viewer",
         "pdf_reports",
+        "jinja2",
+        "pypugjs",
     ],
+    # Optional accelerators: compiled pattern search, multithreaded bedmethyl reader
+    extras_require={"fast": ["numba", "pyarrow"]},
     include_package_data=True,
 )
@@ -1,8 +1,27 @@
+import io
+import pickle
+import random
+import re
+import xml.etree.ElementTree as ElementTree
+
 import epijinn
+from epijinn import _kernels, Bedmethyl, Methyl
+from epijinn.Bedmethyl import BedResult, is_in_sorted, make_figure_picklable
+from epijinn.Methyl import EcoGII, compile_site, find_methylation_sites
+from epijinn.reports import bed_to_html, minify_svg
 
 import Bio
+import dnachisel
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.ticker
+import numpy as np
+import pandas
+import pytest
+from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
+from pdf_reports import add_css_class, dataframe_to_html, style_table_rows
 
 
 def test_Methylase():
@@ -13,6 +32,8 @@ def test_Methylase():
     assert EcoKDam.reverse("ACGT") == "TGCA"
     assert EcoKDam.complement("ACGT") == "TGCA"
     assert EcoKDam.reverse_complement("ACGT") == "ACGT"
+    with pytest.raises(KeyError):
+        EcoKDam.complement("ACGZ")
 
 
 def test_Methylator():
@@ -28,8 +49,362 @@ def test_Methylator():
     assert methylator.report
 
 
+def test_Methylator_regions():
+    def as_tuples(regions):
+        return [(region.start, region.end, region.strand) for region in regions]
+
+    def find_regions_with_dnachisel(sequence, site):
+        return as_tuples(dnachisel.SequencePattern(site).find_matches(sequence))
+
+    random.seed(7)
+    sequence = "".join(random.choice("ACGT") for _ in range(2000))
+    # Palindromic, non-palindromic and overlapping (AAA) literal sites:
+    for site in ["GATC", "CGTCTC", "AAA"]:
+        methylator = epijinn.Methylator(sequence, site=site)
+        regions = as_tuples(methylator.regions)
+        expected = find_regions_with_dnachisel(sequence, site)
+        expected += find_regions_with_dnachisel(sequence, methylator.site_rc)
+        assert len(regions) > 0
+        assert regions == expected
+    # Wildcards and alternations (without a reverse complement):
+    methylator = epijinn.Methylator(sequence, site="GATC")
+    for site in ["GG[AT]CC", "G.TC", "A.{2}A", "(GATC|GAT|AATT)", "(AA|AAA)"]:
+        regions = as_tuples(methylator.find_site_regions(compile_site(site)))
+        expected = find_regions_with_dnachisel(sequence, site)
+        assert len(regions) > 0
+        assert regions == expected
+
+
 def test_annotate_methylation():
     dna = Seq("TGACCCCCCCCTGCTCCCCCAGCACCCCCCCCTCA")
     dna_record = SeqRecord(dna, id="example", annotations={"molecule_type": "dna"})
     dna_annotated = epijinn.annotate_methylation(dna_record)
     assert len(dna_annotated.features) == 12
+
+
+def test_find_methylation_sites():
+    random.seed(12)
+    methylases = list(epijinn.METHYLASES.values()) + [EcoGII]
+    # With a match of each methylase, including the long patterns:
+    sequence = "".join(random.choice("ACGT") for _ in range(1000))
+    for methylase in methylases:
+        site = methylase.sequence.replace("N", "G").replace("W", "T")
+        sequence += site + "".join(random.choice("ACGT") for _ in range(20))
+    for methylase in methylases:
+        # The sites annotated as "@epijinn(<nucleotide>, strand=<strand>)":
+        record = SeqRecord(Seq(sequence), annotations={"molecule_type": "DNA"})
+        epijinn.annotate_methylation(record, methylases=[methylase])
+        expected = []
+        for feature in record.features:
+            label = re.fullmatch(
+                r"@epijinn\((\w), strand=(-?1)\)", feature.qualifiers["label"]
+            )
+            if label:
+                strand = int(label.group(2))
+                assert feature.location.strand == strand
+                expected.append((int(feature.location.start), strand, label.group(1)))
+
+        positions, strands, nucleotides = find_methylation_sites(
+            sequence.encode(), methylase
+        )
+        sites = list(zip(positions.tolist(), strands.tolist(), nucleotides.tolist()))
+        assert len(sites) > 0
+        assert sites == expected
+
+
+def test_BedResult():
+    record = SeqRecord(Seq("ACGTTCGA"), annotations={"molecule_type": "DNA"})
+    bed = pandas.DataFrame({"LOC": [1, 2, 2, 3], "STATUS": ["1", "0", "1", "U"]})
+    bedresult = BedResult(
+        modification="m", methylase=epijinn.METHYLASES["CpG"], bed=bed, record=record
+    )
+    assert bedresult.img_created
+    features = bedresult.record.features
+    assert [int(feature.location.start) for feature in features] == [1, 2, 5, 6]
+    assert [feature.location.strand for feature in features] == [1, -1, 1, -1]
+    # The first entry of a location is used, and sites without an entry get "?":
+    statuses = [feature.qualifiers["status"] for feature in features]
+    assert statuses == ["1", "0", "?", "?"]
+    assert len(record.features) == 0  # the sites are annotated on a copy
+
+    # Too many sites (2 per CpG) to plot:
+    record = SeqRecord(Seq("ACGT" * 30), annotations={"molecule_type": "DNA"})
+    bedresult = BedResult(
+        modification="m", methylase=epijinn.METHYLASES["CpG"], bed=bed, record=record
+    )
+    assert not bedresult.img_created
+    assert not hasattr(bedresult, "plot")
+
+
+def test_binarize_bed():
+    bed = pandas.DataFrame({"percent_modified": [0.0, 30.0, 50.0, 70.0, 100.0]})
+    binarized = epijinn.BedmethylItem.binarize_bed(
+        bed, met_cutoff=0.7, nonmet_cutoff=0.3
+    )
+    assert list(binarized["status"]) == ["0", "0", "U", "1", "1"]
+
+
+def test_binarize_codes():
+    percent_modified = np.array([0.0, 29.9, 30.0, 50.0, 70.0, 100.0, np.nan])
+    # The Python loop is what Numba compiles:
+    expected = _kernels._binarize_loop(percent_modified, 70.0, 30.0)
+    assert list(expected) == [2, 2, 2, 0, 1, 1, 0]
+    for binarize_codes in [_kernels._binarize_numpy, _kernels.binarize_codes]:
+        assert np.array_equal(binarize_codes(percent_modified, 70.0, 30.0), expected)
+    # Overlapping cutoffs: the methylated cutoff takes precedence
+    expected = _kernels._binarize_loop(percent_modified, 40.0, 60.0)
+    for binarize_codes in [_kernels._binarize_numpy, _kernels.binarize_codes]:
+        assert np.array_equal(binarize_codes(percent_modified, 40.0, 60.0), expected)
+
+
+def test_scan_bases():
+    sequence = np.frombuffer(b"ACGTTGCAGGNCcg", dtype=np.uint8)
+    for scan_bases in [
+        _kernels._scan_bases_loop,
+        _kernels._scan_bases_numpy,
+        _kernels.scan_bases,
+    ]:
+        positive, negative = scan_bases(sequence, ord("C"), ord("G"))
+        assert list(positive) == [1, 6, 11]
+        assert list(negative) == [2, 5, 8, 9]
+        positive, negative = scan_bases(sequence, ord("N"), ord("N"))
+        assert list(positive) == list(negative) == [10]
+        positive, negative = scan_bases(sequence[:0], ord("C"), ord("G"))
+        assert len(positive) == len(negative) == 0
+
+
+def test_find_pattern_starts(monkeypatch):
+    def find_pattern_starts_with_dnachisel(sequence, pattern):
+        expression = dnachisel.DnaNotationPattern.dna_sequence_to_regexpr(pattern)
+        matches = dnachisel.SequencePattern(expression).find_matches(sequence)
+        return [match.start for match in matches]
+
+    random.seed(123)
+    sequences = ["", "GATC", "gatcGATCNNWCCAGGccwgg"] + [
+        "".join(random.choice("ACGTNWacgt") for _ in range(300)) for _ in range(20)
+    ]
+    patterns = [methylase.sequence for methylase in epijinn.METHYLASES.values()]
+    patterns += [methylase.rc for methylase in epijinn.METHYLASES.values()]
+    for use_numba in [True, False]:
+        if not use_numba:  # test the NumPy search
+            monkeypatch.setattr(Methyl, "match_pattern", None)
+        for sequence in sequences:
+            for pattern in patterns:
+                starts = Methyl.find_pattern_starts(sequence.encode(), pattern)
+                expected = find_pattern_starts_with_dnachisel(sequence, pattern)
+                assert list(starts) == expected
+
+
+def test_read_bedmethyl(tmp_path, monkeypatch):
+    bed_path = tmp_path / "sample.bed"
+    bed_path.write_text(
+        "ref\t0\t1\tm\t33\t+\t0\t1\t255,0,0\t33\t70.0\t23\t10\t0\t0\t1\t0\t2\n"
+        "ref\t1\t2\ta\t39\t-\t1\t2\t255,0,0\t39\t77.3\t30\t9\t0\t0\t1\t0\t2\n"
+        "ref\t2\t3\tm\t34\t.\t2\t3\t255,0,0\t34\t29.39\t9\t25\t0\t0\t1\t0\t2\n"
+    )
+    bed = Bedmethyl.read_bedmethyl(str(bed_path))  # PyArrow if installed
+    monkeypatch.setattr(Bedmethyl, "PYARROW_AVAILABLE", False)
+    bed_pandas = Bedmethyl.read_bedmethyl(str(bed_path))
+    pandas.testing.assert_frame_equal(bed, bed_pandas)
+    assert list(bed.columns) == Bedmethyl.BEDMETHYL_HEADER
+    assert list(bed["strand"]) == ["+", "-", "."]
+    assert list(bed["percent_modified"]) == [70.0, 77.3, 29.39]
+
+
+def test_is_in_sorted():
+    values = np.array([0, 3, 5, 9, 12, 5])
+    sorted_array = np.array([3, 5, 8, 12])
+    expected = np.isin(values, sorted_array)
+    assert np.array_equal(is_in_sorted(values, sorted_array), expected)
+    assert not is_in_sorted(values, sorted_array[:0]).any()
+    assert len(is_in_sorted(values[:0], sorted_array)) == 0
+
+
+def test_bed_to_html():
+    def tr_modifier(tr):
+        tds = list(tr.find_all("td"))
+        if len(tds) != 0 and tds[-1].text == "1":
+            add_css_class(tr, "negative")
+
+    classes = ("ui", "compact", "celled", "table", "groups")
+    for percentages in [
+        [43.14, 5.0, 70.0, float("nan")],
+        [1e16, 1.0, 2.5, 0.0],  # scientific notation
+        [1e-07, 1.0, 2.5, 0.0],
+        [float("inf"), -1.5, 1e6, 3.0],
+    ]:
+        bed = pandas.DataFrame(
+            {
+                "LOC": [75, 77, 201, 203],
+                "Strand": pandas.Categorical(["+", "-", "+", "-"]),
+                "% mod": percentages,
+                "STATUS": ["U", "1", "0", "1"],
+            }
+        )
+        expected = dataframe_to_html(
+            bed, extra_classes=classes, use_default_classes=False
+        )
+        expected = style_table_rows(expected, tr_modifier)
+        assert bed_to_html(bed) == expected
+    # A fixed-point column, formatted with the float_format of pandas if it is set:
+    bed["% mod"] = [43.14, 5.0, 70.0, float("nan")]
+    with pandas.option_context("display.float_format", "{:.1f}".format):
+        expected = dataframe_to_html(
+            bed, extra_classes=classes, use_default_classes=False
+        )
+        expected = style_table_rows(expected, tr_modifier)
+        assert "<td>43.1</td>" in expected
+        assert bed_to_html(bed) == expected
+    assert 'class="negative"' not in bed_to_html(bed[bed["STATUS"] != "1"])
+
+
+def test_minify_svg():
+    fig, ax = plt.subplots(1, 1, figsize=(4, 2))
+    ax.plot([0.123456, 1.987654, 2.5], [1.0 / 3, 2.0 / 3, 0.5])
+    ax.set_title("Title")
+    output = io.BytesIO()
+    fig.savefig(output, format="svg")
+    plt.close(fig)
+    svg = output.getvalue()
+    minified = minify_svg(svg)
+
+    assert len(minified) < len(svg)
+    assert b"<metadata>" not in minified
+    assert not re.search(rb">\s+<", minified)
+    # The path coordinates keep at most 3 decimals, and only lose the others:
+    paths = list(ElementTree.fromstring(svg).iter("{http://www.w3.org/2000/svg}path"))
+    minified_paths = list(
+        ElementTree.fromstring(minified).iter("{http://www.w3.org/2000/svg}path")
+    )
+    assert len(paths) == len(minified_paths)
+    for path, minified_path in zip(paths, minified_paths):
+        numbers = re.findall(r"-?\d+(?:\.\d+)?", path.get("d", ""))
+        minified_numbers = re.findall(r"-?\d+(?:\.\d+)?", minified_path.get("d", ""))
+        assert len(numbers) == len(minified_numbers)
+        for number, minified_number in zip(numbers, minified_numbers):
+            assert len(minified_number.partition(".")[2]) <= 3
+            assert abs(float(number) - float(minified_number)) < 1e-3
+        assert path.get("transform") == minified_path.get("transform")
+
+
+def test_make_figure_picklable():
+    record = SeqRecord(Seq("ACGTTCGA" * 10), annotations={"molecule_type": "DNA"})
+    bedmethylitem = epijinn.BedmethylItem("bc1", record, pandas.DataFrame())
+    ruler_ax = bedmethylitem.fig.axes[0]
+    fig, ax = plt.subplots(1, 1)
+    user_formatter = matplotlib.ticker.FuncFormatter(lambda x, pos: "%d bp" % x)
+    ax.xaxis.set_major_formatter(user_formatter)
+    for figure in [bedmethylitem.fig, fig]:
+        make_figure_picklable(figure)
+        plt.close(figure)
+    # Only the ruler lambda is replaced, with the same formatting:
+    ruler_formatter = ruler_ax.xaxis.get_major_formatter()
+    assert ruler_formatter(1234.5) == "1,234"
+    pickle.dumps(bedmethylitem.fig)
+    assert ax.xaxis.get_major_formatter() is user_formatter
+
+
+def write_example_samples(directory):
+    """Write a sample sheet, a parameter sheet, a Genbank file and bedmethyl files
+    of two samples of the same reference, and return the sheet paths."""
+    random.seed(42)
+    sequence = "".join(random.choice("ACGT") for _ in range(300))
+    sequence = sequence[:100] + "GGATCC" + sequence[106:200] + "CCAGG" + sequence[205:]
+    record = SeqRecord(Seq(sequence), id="ref", annotations={"molecule_type": "DNA"})
+    SeqIO.write(record, str(directory / "ref.gb"), "genbank")
+    for sample in ["bc1", "bc2"]:
+        lines = []
+        for position, base in enumerate(sequence):
+            for code, strand in [("m", "+"), ("m", "-"), ("a", "+"), ("a", "-")]:
+                if base == {"m+": "C", "m-": "G", "a+": "A", "a-": "T"}[code + strand]:
+                    coverage = random.randint(1, 40)
+                    percentage = round(random.random() * 100, 2)
+                    n_mod = int(coverage * percentage / 100)
+                    row = ["ref", position, position + 1, code, coverage, strand]
+                    row += [position, position + 1, "255,0,0", coverage, percentage]
+                    row += [n_mod, coverage - n_mod, 0, 0, 1, 0, 2]
+                    lines.append("\t".join(map(str, row)))
+        (directory / (sample + ".bed")).write_text("\n".join(lines) + "\n")
+    sample_sheet = directory / "samples.csv"
+    sample_sheet.write_text("project,bc1,ref,bc1.bed\nproject,bc2,ref,bc2.bed\n")
+    parameter_sheet = directory / "parameters.csv"
+    parameter_sheet.write_text("Parameter,Value\nmethylases,EcoKDcm BamHI CpG GpC\n")
+    return str(sample_sheet), str(parameter_sheet)
+
+
+def read_example_samples(directory, n_workers=1):
+    sample_sheet, parameter_sheet = write_example_samples(directory)
+    return epijinn.read_sample_sheet(
+        sample_sheet,
+        genbank_dir=str(directory),
+        bedmethyl_dir=str(directory),
+        parameter_sheet=parameter_sheet,
+        n_workers=n_workers,
+    )
+
+
+def test_perform_all_analysis_in_process_pool(tmp_path):
+    bedmethylitemgroup = read_example_samples(tmp_path)
+    bedmethylitemgroup.perform_all_analysis_in_bedmethylitemgroup()
+    bedmethylitemgroup_pool = read_example_samples(tmp_path)
+    items_pool = list(bedmethylitemgroup_pool.bedmethylitems)
+    bedmethylitemgroup_pool.perform_all_analysis_in_bedmethylitemgroup(n_workers=2)
+    # The items are analysed in place:
+    for item, item_pool in zip(bedmethylitemgroup_pool.bedmethylitems, items_pool):
+        assert item is item_pool
+
+    for item, item_pool in zip(
+        bedmethylitemgroup.bedmethylitems, bedmethylitemgroup_pool.bedmethylitems
+    ):
+        assert item.sample == item_pool.sample
+        assert "fig" not in vars(item_pool)  # plotted when first accessed
+        assert len(item.results) == len(item_pool.results) > 0
+        for result, result_pool in zip(item.results, item_pool.results):
+            pandas.testing.assert_frame_equal(result.bed, result_pool.bed)
+            assert result.img_created == result_pool.img_created
+            if result.img_created:
+                statuses = [f.qualifiers["status"] for f in result.record.features]
+                statuses_pool = [
+                    f.qualifiers["status"] for f in result_pool.record.features
+                ]
+                assert statuses == statuses_pool
+
+
+def test_read_sample_sheet_in_thread_pool(tmp_path):
+    bedmethylitemgroup = read_example_samples(tmp_path)
+    bedmethylitemgroup_pool = read_example_samples(tmp_path, n_workers=2)
+
+    for item, item_pool in zip(
+        bedmethylitemgroup.bedmethylitems, bedmethylitemgroup_pool.bedmethylitems
+    ):
+        assert item.sample == item_pool.sample
+        assert str(item.record.seq) == str(item_pool.record.seq)
+        pandas.testing.assert_frame_equal(item.bed, item_pool.bed)
+    # Both samples are of the same Genbank record, read once and copied:
+    record, other_record = [item.record for item in bedmethylitemgroup.bedmethylitems]
+    assert record.annotations is not other_record.annotations
+    assert record.features is not other_record.features
+
+
+def test_write_bedmethylitemgroup_report_in_process_pool(tmp_path, monkeypatch):
+    # Fixed SVG ids, so that the figures of both reports are identical:
+    monkeypatch.setitem(matplotlib.rcParams, "svg.hashsalt", "epijinn")
+    bedmethylitemgroup = read_example_samples(tmp_path)
+    bedmethylitemgroup.perform_all_analysis_in_bedmethylitemgroup()
+    html_file = tmp_path / "report.html"
+    html_file_pool = tmp_path / "report_pool.html"
+    epijinn.write_bedmethylitemgroup_report(
+        bedmethylitemgroup, pdf_file=None, html_file=str(html_file)
+    )
+    for bedmethylitem in bedmethylitemgroup.bedmethylitems:
+        assert isinstance(bedmethylitem.bedmethylitem_figure_data, str)
+    epijinn.write_bedmethylitemgroup_report(
+        bedmethylitemgroup,
+        pdf_file=None,
+        html_file=str(html_file_pool),
+        n_workers=2,
+    )
+    html = html_file.read_text()
+    assert "data:image/svg+xml;base64," in html
+    assert html == html_file_pool.read_text()
+    assert len(plt.get_fignums()) == 0  # the figures are closed once rendered